@@ -21,60 +21,95 @@ Security:
 
 Requirements:
   pip install krakenex
+  pip install orjson   (optional, faster JSON decoding of large trade pages)
 
 Environment Variables:
   KRAKEN_KEY, KRAKEN_SECRET
+  KRAKEN_CACHE_DIR (optional) — cache the fetched trade history on disk for faster re-runs
 """
 
 import os
+import re
+import argparse
 import csv
 import sys
+import json
 import time
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal, getcontext
-from collections import defaultdict, deque
+from collections import defaultdict
 
 import krakenex
 import random
 
+try:
+    import orjson  # optional C JSON parser
+except ImportError:
+    orjson = None
+
 # ========= Config (tweak as you like) =========
 INCLUDE_FEES_IN_COST = True   # True => buy cost includes fees; sell proceeds are net of fees
 ONLY_THESE_QUOTES = None      # e.g., {"USD", "USDT"} to only analyze those quotes; None for all
 CSV_OUT = "kraken_trade_averages.csv"
 REQUEST_SLEEP = 0.2           # base pacing for pagination; private endpoints are stricter
 USE_MIDPRICE = False          # True => use mid (bid+ask)/2; False => last traded price
+PAGE_WORKERS = 4              # concurrent TradesHistory page requests (1 => fully serial)
 
 # Robust rate-limit handling (exponential backoff with jitter)
 MAX_RETRIES = 8               # maximum backoff attempts per call
 BASE_BACKOFF = 0.8            # starting backoff seconds
 BACKOFF_JITTER = 0.35         # +/- random jitter to avoid thundering herds
+NONCE_RETRIES = 3             # quick retries for out-of-order nonces (separate from MAX_RETRIES)
 
-# Use high precision decimals for financial math
+# Use high precision decimals for parsing/display; arithmetic runs on scaled ints
 getcontext().prec = 28
+SCALE = 10 ** 10              # fixed-point scale: amounts are ints in units of 1e-10
 
 # ========= Rate limit helpers =========
+def error_message(resp):
+    """Flatten Kraken's resp["error"] (list) into one lowercase string."""
+    if not isinstance(resp, dict):
+        return ""
+    errs = resp.get("error") or []
+    if isinstance(errs, list):
+        return " ".join(errs).lower()
+    return str(errs).lower()
+
 def is_rate_limit_error(resp):
     """
     Kraken errors come back in resp["error"] (list).
     We detect the "EAPI:Rate limit exceeded" style messages and trigger backoff.
     """
-    if not isinstance(resp, dict):
-        return False
-    errs = resp.get("error") or []
-    if isinstance(errs, list):
-        msg = " ".join(errs).lower()
-    else:
-        msg = str(errs).lower()
+    msg = error_message(resp)
     return ("rate limit" in msg) or ("exceeded" in msg)
 
+def is_nonce_error(resp):
+    """
+    KrakenClient never reuses a nonce, but concurrent calls can still reach Kraken out of
+    nonce order ("EAPI:Invalid nonce"). Retrying is safe: every attempt is signed with a fresh, larger nonce.
+    A persistent invalid nonce (e.g. the key was used with larger nonces elsewhere) won't recover,
+    so these get only NONCE_RETRIES short retries.
+    """
+    return "invalid nonce" in error_message(resp)
+
 def kraken_private_with_retry(k, endpoint, params=None):
     """
     Wrapper for private endpoints with exponential backoff on rate-limit.
     Will retry up to MAX_RETRIES before returning the last response (caller raises).
+    Nonce races get up to NONCE_RETRIES brief retries instead of the full backoff.
     """
     params = params or {}
     tries = 0
+    nonce_tries = 0
     while True:
         resp = k.query_private(endpoint, params)
+        if is_nonce_error(resp) and nonce_tries < NONCE_RETRIES:
+            nonce_tries += 1
+            time.sleep(random.uniform(0.05, 0.25))
+            continue
         if not is_rate_limit_error(resp):
             return resp
         # Backoff with jitter
@@ -87,8 +122,19 @@ def kraken_private_with_retry(k, endpoint, params=None):
             return resp
 
 # ========= Small utility helpers =========
-def d(x): return Decimal(str(x))
-def safe_div(n, dnm): return (n / dnm) if dnm != 0 else Decimal("0")
+def d(x): return x if isinstance(x, Decimal) else Decimal(str(x))
+def to_fixed(x): return int(d(x) * SCALE)
+def from_fixed(n): return Decimal(n) / SCALE
+def fixed_div(n, dnm): return (n * SCALE) // dnm if dnm != 0 else 0
+
+# Pair-name grammar, compiled once:
+#   legacy fiat-quoted "XBASEZQUOTE" (e.g. XETHZUSD), legacy crypto-quoted "XBASEXQUOTE" (e.g. XETHXXBT),
+#   or modern "BASEQUOTE" ending in a well-known quote (e.g. SOLUSD)
+PAIR_RE = re.compile(
+    r"^X?(?P<lbase>[A-Z0-9]{3,4})Z(?P<lquote>[A-Z]{3,4})$"
+    r"|^X(?P<xbase>[A-Z0-9]{3,4})X(?P<xquote>[A-Z]{3,4})$"
+    r"|^(?P<base>[A-Z0-9]+?)(?P<quote>USDT|USDC|USD|EUR|GBP|CAD|AUD|CHF|JPY|BTC|ETH|DAI)$"
+)
 
 def parse_pair(pair: str):
     """
@@ -99,14 +145,11 @@ def parse_pair(pair: str):
     if not pair:
         return "", ""
     p = pair.replace("/", "").upper().replace("XBT", "BTC")
-    # Legacy "BASEZQUOTE" format (e.g. XETHZUSD)
-    if "Z" in p and len(p) >= 7:
-        i = p.rfind("Z")
-        left, right = p[:i], p[i+1:]
-        if left and right and 3 <= len(right) <= 4:
-            if left.startswith("X") and len(left) >= 2:
-                left = left[1:]  # drop leading 'X'
-            return left, right
+    m = PAIR_RE.match(p)
+    if m:
+        base = m.group("lbase") or m.group("xbase") or m.group("base")
+        quote = m.group("lquote") or m.group("xquote") or m.group("quote")
+        return base, quote
     # Otherwise, assume last 3–4 chars are quote symbol
     for qlen in (4, 3):
         if len(p) > qlen:
@@ -114,42 +157,69 @@ def parse_pair(pair: str):
     return p, ""
 
 # ========= Output helpers =========
+# Column order of the summary table; every row is a tuple of strings in this order
+HEADERS = (
+    "asset","quote","total_bought","avg_buy_price",
+    "total_sold","avg_sell_price","net_from_history",
+    "remaining_unsold_volume","avg_buy_price_of_remaining",
+    "fees_total","realized_pnl","current_price","unrealized_pnl"
+)
+
 def pretty_print(rows):
     """Print the final summary table to stdout."""
     if not rows:
         print("No trades found.")
         return
-    headers = [
-        "asset","quote","total_bought","avg_buy_price",
-        "total_sold","avg_sell_price","net_from_history",
-        "remaining_unsold_volume","avg_buy_price_of_remaining",
-        "fees_total","realized_pnl","current_price","unrealized_pnl"
-    ]
-    widths = {h: max(len(h), max((len(r[h]) for r in rows), default=0)) for h in headers}
-    line = " | ".join(h.ljust(widths[h]) for h in headers)
+    # Column widths in a single pass over the rows
+    widths = [len(h) for h in HEADERS]
+    for r in rows:
+        for i, v in enumerate(r):
+            if len(v) > widths[i]:
+                widths[i] = len(v)
+    fmt = " | ".join(f"{{:<{w}}}" for w in widths)
+    line = fmt.format(*HEADERS)
     print(line)
     print("-" * len(line))
     for r in rows:
-        print(" | ".join(r[h].ljust(widths[h]) for h in headers))
+        print(fmt.format(*r))
 
 def write_csv(rows, path):
     """Write the summary table to CSV so you can open it in Excel/Sheets."""
     if not rows:
         return
-    headers = [
-        "asset","quote","total_bought","avg_buy_price",
-        "total_sold","avg_sell_price","net_from_history",
-        "remaining_unsold_volume","avg_buy_price_of_remaining",
-        "fees_total","realized_pnl","current_price","unrealized_pnl"
-    ]
     with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=headers)
-        w.writeheader()
-        for r in rows:
-            w.writerow(r)
+        w = csv.writer(f)
+        w.writerow(HEADERS)
+        w.writerows(rows)
     print(f"Wrote {path}")
 
 # ========= Krakenex client & fetch =========
+class KrakenClient(krakenex.API):
+    """
+    krakenex client that decodes responses with orjson when it is installed.
+    Each client keeps one requests.Session, so reusing a client keeps the HTTPS connection alive.
+    """
+    # Nonces are shared by every client in the process: krakenex's default int(1000*time.time())
+    # repeats when page workers sign in the same millisecond, which Kraken rejects.
+    _nonce_lock = threading.Lock()
+    _last_nonce = 0
+
+    def _nonce(self):
+        """Strictly increasing millisecond nonce across all threads (same unit as krakenex)."""
+        with KrakenClient._nonce_lock:
+            KrakenClient._last_nonce = max(KrakenClient._last_nonce + 1, time.time_ns() // 1_000_000)
+            return KrakenClient._last_nonce
+
+    def _query(self, urlpath, data, headers=None, timeout=None):
+        # Same request/status handling as krakenex 2.x API._query; only the decode step differs.
+        # orjson takes no decoder options, so clients configured via json_options() keep the stock path.
+        if orjson is None or getattr(self, "_json_options", None):
+            return super()._query(urlpath, data, headers, timeout)
+        self.response = self.session.post(self.uri + urlpath, data=data or {}, headers=headers or {}, timeout=timeout)
+        if self.response.status_code not in (200, 201, 202):
+            self.response.raise_for_status()
+        return orjson.loads(self.response.content)
+
 def get_client():
     """
     Build a Krakenex client using env vars.
@@ -159,35 +229,91 @@ def get_client():
     api_secret = os.environ.get("KRAKEN_SECRET")
     if not api_key or not api_secret:
         raise RuntimeError("Set KRAKEN_KEY and KRAKEN_SECRET environment variables.")
-    return krakenex.API(key=api_key, secret=api_secret)
+    return KrakenClient(key=api_key, secret=api_secret)
+
+def disk_cached(fn):
+    """
+    Cache the result of fn(k) as one JSON file under $KRAKEN_CACHE_DIR (if set), keyed by
+    (api key, function name). Only complete results are written, so an interrupted run never
+    leaves a partial trade history behind. Delete the directory to pick up new trades.
+    """
+    @functools.wraps(fn)
+    def wrapper(k):
+        cache_dir = os.environ.get("KRAKEN_CACHE_DIR")
+        if not cache_dir:
+            return fn(k)
+        key = (getattr(k, "key", ""), fn.__name__)
+        path = os.path.join(cache_dir, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                result = json.load(f)
+            print(f"Loaded cached trade history from {path} (delete it to refetch).")
+            return result
+        except (OSError, ValueError):
+            pass  # miss or unreadable entry; fetch fresh
+        result = fn(k)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(result, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"WARNING: could not write cache file {path}: {e}")
+        return result
+    return wrapper
+
+def fetch_trades_page(k, ofs, end=None):
+    """Fetch one TradesHistory page starting at 'ofs' (up to time 'end', inclusive) and return its result dict."""
+    params = {"ofs": ofs}
+    if end is not None:
+        params["end"] = end
+    resp = kraken_private_with_retry(k, "TradesHistory", params)
+    if resp.get("error"):
+        raise RuntimeError(f"TradesHistory error: {resp['error']}")
+    return resp.get("result", {}) or {}
 
+@disk_cached
 def fetch_all_trades(k):
     """
     Page through TradesHistory and return a flat list of trade dicts.
-    Kraken returns trades in pages via 'ofs'. We respect rate limits and pace requests.
+    The first page tells us the total 'count'; the remaining offsets are then fetched
+    by up to PAGE_WORKERS threads. Each request still goes through the retry/backoff wrapper.
+    Later pages are pinned to the newest trade time seen on the first page, so fills that
+    land mid-fetch cannot shift older trades past the last offset we request.
     """
-    trades = []
-    ofs = 0
-    while True:
-        resp = kraken_private_with_retry(k, "TradesHistory", {"ofs": ofs})
-        if resp.get("error"):
-            raise RuntimeError(f"TradesHistory error: {resp['error']}")
-        result = resp.get("result", {}) or {}
-        trades_map = result.get("trades", {}) or {}
-        page = list(trades_map.values())
-        trades.extend(page)
-        count = result.get("count", 0)
-        ofs += len(page)
-        if ofs >= count:
-            break
+    print("Fetching trades from Kraken (read-only)…")
+    result = fetch_trades_page(k, 0)
+    trades = dict(result.get("trades", {}) or {})  # keyed by txid, so overlapping pages dedupe
+    count = result.get("count", 0)
+    page_size = len(trades)
+    if not page_size or page_size >= count:
+        return list(trades.values())
+    end = max(float(t.get("time") or 0) for t in trades.values())
+
+    # One client per worker thread (requests.Session is not thread-safe); each is reused across its pages
+    local = threading.local()
+
+    def fetch(ofs):
+        if not hasattr(local, "k"):
+            local.k = type(k)(key=k.key, secret=k.secret)
         # Private endpoints are stricter; go slower if you still see throttling
         time.sleep(max(REQUEST_SLEEP, 0.8))
-    return trades
+        return fetch_trades_page(local.k, ofs, end)
+
+    offsets = range(page_size, count, page_size)
+    with ThreadPoolExecutor(max_workers=max(PAGE_WORKERS, 1)) as pool:
+        for page in pool.map(fetch, offsets):
+            if page.get("count", count) != count:
+                # A fill landed in the same second as 'end'; offsets no longer line up with page 0
+                raise RuntimeError("Trade history changed while paging; please re-run.")
+            trades.update(page.get("trades", {}) or {})
+    return list(trades.values())
 
 def fetch_current_prices(k, pair_names):
     """
     Use the public Ticker endpoint to fetch current prices for the Kraken-native pair names we saw in history.
-    Returns: { pair_name: Decimal(price) }
+    Returns: { pair_name: fixed-point price (int, see SCALE) }
     """
     if not pair_names:
         return {}
@@ -200,49 +326,109 @@ def fetch_current_prices(k, pair_names):
     for pair_name, data in result.items():
         if USE_MIDPRICE:
             # midpoint of best bid/ask
-            bid = d((data.get("b", ["0"])[0]))
-            ask = d((data.get("a", ["0"])[0]))
-            prices[pair_name] = safe_div((bid + ask), d(2))
+            bid = to_fixed(data.get("b", ["0"])[0])
+            ask = to_fixed(data.get("a", ["0"])[0])
+            prices[pair_name] = (bid + ask) // 2
         else:
             # last traded price
             last = data.get("c", ["0"])[0]
-            prices[pair_name] = d(last)
+            prices[pair_name] = to_fixed(last)
     return prices
 
 # ========= Core aggregation (build lots & stats) =========
+def fifo_match(vols, costs, head, qty, proceeds):
+    """
+    Match a sell of 'qty' units (worth 'proceeds') against the open lots starting at index 'head'.
+    Lots live in parallel lists (remaining_vol, total_cost);
+    consumed lots are skipped by advancing the head index and a partially filled head lot
+    is updated in place. All amounts are fixed-point ints. Returns
+    (realized_pnl, matched_vol, matched_cost, head) for the matched portion
+    (sell volume beyond the lots is ignored).
+    """
+    sell_vol = qty
+    matched_vol = 0
+    matched_cost = 0
+    n = len(vols)
+    while qty > 0 and head < n:
+        lot_vol = vols[head]
+        if lot_vol <= qty:
+            # Whole lot consumed
+            matched_vol += lot_vol
+            matched_cost += costs[head]
+            qty -= lot_vol
+            head += 1
+        else:
+            # Partial fill of the head lot: split its cost pro rata, not via a rounded unit price
+            lot_cost = costs[head]
+            used_cost = lot_cost * qty // lot_vol
+            matched_vol += qty
+            matched_cost += used_cost
+            vols[head] = lot_vol - qty
+            costs[head] = lot_cost - used_cost
+            qty = 0
+    if not matched_vol:
+        return 0, 0, 0, head
+    # Proceeds are likewise split pro rata over the matched share of the sell
+    realized = proceeds * matched_vol // sell_vol - matched_cost
+    return realized, matched_vol, matched_cost, head
+
+def validate_trades(trades):
+    """
+    Parse raw Kraken trade dicts in a single pass, dropping malformed rows.
+    Returns (ts, pair_name, type, vol, cost, fee) tuples with fixed-point amounts,
+    sorted oldest-first (Kraken returns newest first; FIFO needs oldest first).
+    """
+    clean = []
+    for t in trades:
+        try:
+            pair_name = (t.get("pair") or "").strip()  # e.g., XXBTZUSD
+            typ       = (t.get("type") or "").lower()  # 'buy' | 'sell'
+            vol       = to_fixed(t.get("vol") or "0")
+            price     = to_fixed(t.get("price") or "0")
+            cost      = to_fixed(t["cost"]) if t.get("cost") else vol * price // SCALE  # Kraken usually provides 'cost'
+            fee       = to_fixed(t.get("fee") or "0")
+            ts        = float(t.get("time") or 0)
+        except (ArithmeticError, ValueError, TypeError, AttributeError):
+            continue
+        clean.append((ts, pair_name, typ, vol, cost, fee))
+    skipped = len(trades) - len(clean)
+    if skipped:
+        print(f"Skipped {skipped} malformed trade(s).")
+    clean.sort(key=lambda row: row[0])
+    return clean
+
 def aggregate_trades(trades):
     """
     Build an aggregated state per (base, quote):
       - Totals for buys/sells/fees
-      - FIFO lot deque representing remaining units (for unrealized PnL & avg cost of remaining)
+      - FIFO lot arrays representing remaining units (for unrealized PnL & avg cost of remaining)
       - Realized PnL based on FIFO (only Kraken-tracked sells)
+    Returns a plain dict ordered by (base, quote), so callers can iterate it without re-sorting.
     """
     agg = defaultdict(lambda: {
-        "buy_vol": Decimal("0"),
-        "buy_cost": Decimal("0"),
-        "sell_vol": Decimal("0"),
-        "sell_proceeds": Decimal("0"),
-        "fees": Decimal("0"),
-        "lots": deque(),      # each lot: [remaining_vol, unit_cost, total_cost]
-        "realized_pnl": Decimal("0"),
+        "buy_vol": 0,         # all amounts are fixed-point ints (see SCALE)
+        "buy_cost": 0,
+        "sell_vol": 0,
+        "sell_proceeds": 0,
+        "fees": 0,
+        "lot_vols": [],       # FIFO lots as parallel arrays: remaining_vol,
+        "lot_costs": [],      # total_cost
+        "head": 0,            # index of the oldest open lot; earlier entries are consumed
+        "rem_vol": 0,         # running totals over the open lots, kept in sync on every change
+        "rem_cost": 0,
+        "realized_pnl": 0,
         "last_ts": 0.0,
         "pair_name": None,    # remember a Kraken-native pair name for pulling Ticker later
     })
 
-    for t in trades:
-        try:
-            pair_name = (t.get("pair") or "").strip()  # e.g., XXBTZUSD
-            typ       = (t.get("type") or "").lower()  # 'buy' | 'sell'
-            vol       = d(t.get("vol") or "0")
-            price     = d(t.get("price") or "0")
-            cost      = d(t.get("cost") or (vol * price))  # Kraken usually provides 'cost'
-            fee       = d(t.get("fee") or "0")
-            ts        = float(t.get("time") or 0)
-        except Exception:
-            # Skip malformed rows just in case
-            continue
+    trades = validate_trades(trades)
+
+    # Normalize each distinct pair name once instead of once per trade
+    unique_pairs = {row[1] for row in trades}
+    pair_map = {p: parse_pair(p) for p in unique_pairs}
 
-        base, quote = parse_pair(pair_name)
+    for ts, pair_name, typ, vol, cost, fee in trades:
+        base, quote = pair_map[pair_name]
         if ONLY_THESE_QUOTES and quote not in ONLY_THESE_QUOTES:
             continue
 
@@ -253,48 +439,36 @@ def aggregate_trades(trades):
 
         if typ == "buy":
             # Add buy to FIFO (including fee if configured)
-            buy_cost = cost + (fee if INCLUDE_FEES_IN_COST else Decimal("0"))
+            buy_cost = cost + (fee if INCLUDE_FEES_IN_COST else 0)
             rec["buy_vol"] += vol
             rec["buy_cost"] += buy_cost
             rec["fees"] += fee
-            unit_cost = safe_div(buy_cost, vol) if vol > 0 else Decimal("0")
-            rec["lots"].append([vol, unit_cost, buy_cost])
+            rec["lot_vols"].append(vol)
+            rec["lot_costs"].append(buy_cost)
+            rec["rem_vol"] += vol
+            rec["rem_cost"] += buy_cost
 
         elif typ == "sell":
             # Compute sell proceeds (net of fees if configured)
-            proceeds = cost - (fee if INCLUDE_FEES_IN_COST else Decimal("0"))
+            proceeds = cost - (fee if INCLUDE_FEES_IN_COST else 0)
             rec["sell_vol"] += vol
             rec["sell_proceeds"] += proceeds
             rec["fees"] += fee
-            per_unit_proceeds = safe_div(proceeds, vol) if vol > 0 else Decimal("0")
 
             # FIFO: match this sell against oldest buy lots to compute realized PnL
-            remaining = vol
-            realized = Decimal("0")
-            while remaining > 0 and rec["lots"]:
-                lot_vol, lot_px, _lot_cost = rec["lots"][0]
-                use = min(lot_vol, remaining)
-                lot_cost_used = use * lot_px
-                portion_proceeds = use * per_unit_proceeds
-                realized += portion_proceeds - lot_cost_used
-
-                lot_vol -= use
-                remaining -= use
-                if lot_vol <= 0:
-                    rec["lots"].popleft()
-                else:
-                    rec["lots"][0][0] = lot_vol
-                    rec["lots"][0][2] = lot_vol * lot_px
+            realized, matched_vol, matched_cost, rec["head"] = fifo_match(
+                rec["lot_vols"], rec["lot_costs"], rec["head"], vol, proceeds)
             rec["realized_pnl"] += realized
+            rec["rem_vol"] -= matched_vol
+            rec["rem_cost"] -= matched_cost
 
-    return agg
+    # Sort once here; dicts keep insertion order for every later pass
+    return {key: agg[key] for key in sorted(agg)}
 
 # ========= Interactive adjustments =========
 def total_remaining(rec):
     """Return (remaining_volume, remaining_cost) over all FIFO lots for a pair."""
-    rem_vol = sum((lot[0] for lot in rec["lots"]), Decimal("0"))
-    rem_cost = sum((lot[2] for lot in rec["lots"]), Decimal("0"))
-    return rem_vol, rem_cost
+    return rec["rem_vol"], rec["rem_cost"]
 
 def shrink_lots_fifo_to_target(rec, target_vol):
     """
@@ -303,20 +477,15 @@ def shrink_lots_fifo_to_target(rec, target_vol):
     NOTE: This does NOT change realized PnL since those external trades aren't in Kraken history.
     """
     current_vol, _ = total_remaining(rec)
-    target_vol = d(target_vol)
+    target_vol = to_fixed(target_vol)
     if target_vol >= current_vol:
         return  # We don't "add" external buys; only shrink
     to_reduce = current_vol - target_vol
-    while to_reduce > 0 and rec["lots"]:
-        lot_vol, lot_px, _lot_cost = rec["lots"][0]
-        use = min(lot_vol, to_reduce)
-        lot_vol -= use
-        to_reduce -= use
-        if lot_vol <= 0:
-            rec["lots"].popleft()
-        else:
-            rec["lots"][0][0] = lot_vol
-            rec["lots"][0][2] = lot_vol * lot_px
+    # Consume the oldest lots like a sell, but discard the PnL (no proceeds are known)
+    _realized, matched_vol, matched_cost, rec["head"] = fifo_match(
+        rec["lot_vols"], rec["lot_costs"], rec["head"], to_reduce, 0)
+    rec["rem_vol"] -= matched_vol
+    rec["rem_cost"] -= matched_cost
 
 def maybe_adjust_balances(agg):
     """
@@ -333,7 +502,7 @@ def maybe_adjust_balances(agg):
 
     # Build list of adjustable entries (those with remaining inventory)
     items = []
-    for (base, quote), rec in sorted(agg.items()):
+    for (base, quote), rec in agg.items():
         rem_vol, _rem_cost = total_remaining(rec)
         if rem_vol > 0:
             items.append(((base, quote), rec, rem_vol))
@@ -346,7 +515,7 @@ def maybe_adjust_balances(agg):
     print("\nSelect which assets to adjust (by index, comma-separated) or type 'all':")
     for idx, (key, rec, rem_vol) in enumerate(items, start=1):
         base, quote = key
-        print(f"[{idx}] {base}/{quote}  remaining={rem_vol}")
+        print(f"[{idx}] {base}/{quote}  remaining={from_fixed(rem_vol)}")
 
     try:
         choice = input("Your choice: ").strip().lower()
@@ -371,7 +540,7 @@ def maybe_adjust_balances(agg):
         (base, quote), rec, rem_vol = items[i-1]
         while True:
             try:
-                target_str = input(f"Set target remaining volume for {base}/{quote} (current {rem_vol}, usually 0): ").strip()
+                target_str = input(f"Set target remaining volume for {base}/{quote} (current {from_fixed(rem_vol)}, usually 0): ").strip()
             except EOFError:
                 return
             try:
@@ -384,66 +553,108 @@ def maybe_adjust_balances(agg):
             except Exception:
                 print("Please enter a valid number (e.g., 0 or 0.123456).")
 
+def apply_adjustments(agg, targets):
+    """
+    Non-interactive counterpart of maybe_adjust_balances.
+    'targets' maps a pair (e.g. "BTC/USD", "XBT/USD" or "XXBTZUSD") to a target remaining volume.
+    """
+    for pair, target in targets.items():
+        rec = agg.get(parse_pair(pair))
+        if rec is None:
+            print(f"No trade history for {pair}; skipping adjustment.")
+            continue
+        shrink_lots_fifo_to_target(rec, target)
+
 # ========= Build final rows (prices, unrealized PnL) =========
 def build_rows_with_prices(agg, k):
     """
     Augment the aggregated data with current prices and compute unrealized PnL.
-    Returns a list of serializable dicts for display/CSV.
+    Returns a list of string tuples (columns in HEADERS order) for display/CSV.
     """
     pair_names = {r["pair_name"] for r in agg.values() if r["pair_name"]}
     prices_by_pair = fetch_current_prices(k, pair_names)
 
     rows = []
-    for (base, quote), r in sorted(agg.items()):
+    for (base, quote), r in agg.items():
         buy_vol = r["buy_vol"]
         sell_vol = r["sell_vol"]
         buy_cost = r["buy_cost"]
         sell_proceeds = r["sell_proceeds"]
 
-        avg_buy = safe_div(buy_cost, buy_vol) if buy_vol > 0 else Decimal("0")
-        avg_sell = safe_div(sell_proceeds, sell_vol) if sell_vol > 0 else Decimal("0")
+        avg_buy = fixed_div(buy_cost, buy_vol) if buy_vol > 0 else 0
+        avg_sell = fixed_div(sell_proceeds, sell_vol) if sell_vol > 0 else 0
 
-        remaining_vol = sum((lot[0] for lot in r["lots"]), Decimal("0"))
-        remaining_cost = sum((lot[2] for lot in r["lots"]), Decimal("0"))
-        remaining_avg_buy = safe_div(remaining_cost, remaining_vol) if remaining_vol > 0 else Decimal("0")
+        remaining_vol, remaining_cost = total_remaining(r)
+        remaining_avg_buy = fixed_div(remaining_cost, remaining_vol) if remaining_vol > 0 else 0
 
-        current_price = prices_by_pair.get(r["pair_name"], Decimal("0"))
+        current_price = prices_by_pair.get(r["pair_name"], 0)
 
-        # Unrealized PnL = sum over remaining lots: (current_price - lot_unit_cost) * lot_vol
-        unrealized = Decimal("0")
+        # Unrealized PnL = current value of the remaining lots minus what they cost
+        unrealized = 0
         if current_price > 0 and remaining_vol > 0:
-            for lot_vol, lot_px, _lot_cost in r["lots"]:
-                unrealized += (current_price - lot_px) * lot_vol
-
-        rows.append({
-            "asset": base,
-            "quote": quote,
-            "total_bought": str(buy_vol),
-            "avg_buy_price": str(avg_buy),
-            "total_sold": str(sell_vol),
-            "avg_sell_price": str(avg_sell),
-            "net_from_history": str(buy_vol - sell_vol),  # units, not money
-            "remaining_unsold_volume": str(remaining_vol),
-            "avg_buy_price_of_remaining": str(remaining_avg_buy),
-            "fees_total": str(r["fees"]),
-            "realized_pnl": str(r["realized_pnl"]),       # realized PnL in quote currency
-            "current_price": str(current_price),          # price from Ticker
-            "unrealized_pnl": str(unrealized),            # unrealized PnL in quote currency
-        })
+            unrealized = current_price * remaining_vol // SCALE - remaining_cost
+
+        # Fixed-point ints are converted back to Decimal only here, for display
+        rows.append((
+            base,
+            quote,
+            str(from_fixed(buy_vol)),
+            str(from_fixed(avg_buy)),
+            str(from_fixed(sell_vol)),
+            str(from_fixed(avg_sell)),
+            str(from_fixed(buy_vol - sell_vol)),     # net_from_history: units, not money
+            str(from_fixed(remaining_vol)),
+            str(from_fixed(remaining_avg_buy)),
+            str(from_fixed(r["fees"])),
+            str(from_fixed(r["realized_pnl"])),      # realized PnL in quote currency
+            str(from_fixed(current_price)),          # price from Ticker
+            str(from_fixed(unrealized)),             # unrealized PnL in quote currency
+        ))
     return rows
 
 # ========= Main =========
+def adjust_targets(text):
+    """argparse type for --adjust: a JSON object of {"BASE/QUOTE": target_volume}."""
+    try:
+        targets = json.loads(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a JSON object, e.g. '{\"BTC/USD\": 0}'")
+    if not isinstance(targets, dict):
+        raise argparse.ArgumentTypeError("expected a JSON object, e.g. '{\"BTC/USD\": 0}'")
+    parsed = {}
+    for pair, target in targets.items():
+        try:
+            target = d(target)
+        except ArithmeticError:
+            raise argparse.ArgumentTypeError(f"invalid target volume for {pair}: {target!r}")
+        if not target.is_finite() or target < 0:
+            raise argparse.ArgumentTypeError(f"target volume for {pair} must be a finite, non-negative number")
+        parsed[pair] = target
+    return parsed
+
+def parse_args(argv=None):
+    """Parse command-line options (see --help)."""
+    parser = argparse.ArgumentParser(description="Kraken trade analyzer: VWAP, FIFO cost basis and PnL per pair.")
+    parser.add_argument(
+        "--adjust", type=adjust_targets, metavar="JSON",
+        help='set remaining volumes without prompting, e.g. \'{"BTC/USD": 0, "ETH/USD": 0.5}\'',
+    )
+    return parser.parse_args(argv)
+
 def main():
+    args = parse_args()
     k = get_client()
-    print("Fetching trades from Kraken (read-only)…")
     trades = fetch_all_trades(k)
-    print(f"Fetched {len(trades)} trades.")
+    print(f"Got {len(trades)} trades.")
 
     # 1) Aggregate trades into FIFO lots + stats
     agg = aggregate_trades(trades)
 
-    # 2) Optional interactive adjustment of remaining balances
-    maybe_adjust_balances(agg)
+    # 2) Optional adjustment of remaining balances (from --adjust, else interactive)
+    if args.adjust is not None:
+        apply_adjustments(agg, args.adjust)
+    else:
+        maybe_adjust_balances(agg)
 
     # 3) Compute prices + unrealized PnL and render outputs
     rows = build_rows_with_prices(agg, k)